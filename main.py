@@ -1,11 +1,12 @@
 import asyncio
-import json
+import multiprocessing
 import os
 import logging
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from spectre_crawler import main
+import aiofiles
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi.middleware.cors import CORSMiddleware
@@ -33,29 +34,95 @@ logging.basicConfig(
 
 NODE_OUTPUT_FILE = "data/nodes.json"
 
-scheduler = AsyncIOScheduler()
+# never stack crawls: skip missed runs and allow a single one at a time
+scheduler = AsyncIOScheduler(
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 60}
+)
+
+# the crawler runs in a fresh process per job so it can't block the API's
+# event loop, and a crashed crawl can't break the next one
+_crawl = {"process": None}
+
+# parsed nodes.json, refreshed only when the file's mtime changes
+_cache = {"mtime": 0, "body": b""}
+_cache_lock = asyncio.Lock()
+
+
+def _parse_accept_encoding(header):
+    """Map each coding in an Accept-Encoding header to its q-value."""
+    qvalues = {}
+    for item in header.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    return qvalues
 
 
 @app.get("/nodes")
-async def read_nodes():
+async def read_nodes(request: Request):
     """Return the contents of nodes.json without updating any geolocation data."""
-    if not os.path.exists(NODE_OUTPUT_FILE):
+    try:
+        st = await asyncio.to_thread(os.stat, NODE_OUTPUT_FILE)
+        if st.st_mtime_ns != _cache["mtime"]:
+            async with _cache_lock:
+                # another request may have refreshed the cache while we waited
+                if st.st_mtime_ns != _cache["mtime"]:
+                    # the file may be gone by now, handled below like a missing stat
+                    async with aiofiles.open(NODE_OUTPUT_FILE, "rb") as f:
+                        raw = await f.read()
+                    try:
+                        body = orjson.dumps(orjson.loads(raw))
+                    except orjson.JSONDecodeError:
+                        logging.error("nodes.json contains invalid JSON data.")
+                        return JSONResponse(
+                            content={"error": "nodes.json contains invalid JSON data."},
+                            status_code=400,
+                        )
+                    _cache["body"] = body
+                    _cache["mtime"] = st.st_mtime_ns
+    except FileNotFoundError:
         logging.error("nodes.json file does not exist. Run the crawler first.")
         return JSONResponse(
             content={"error": "nodes.json file does not exist. Run the crawler first."},
             status_code=404,
         )
 
-    try:
-        with open(NODE_OUTPUT_FILE, "r") as f:
-            data = json.loads(f.read())
-    except json.JSONDecodeError:
-        logging.error("nodes.json contains invalid JSON data.")
-        return JSONResponse(
-            content={"error": "nodes.json contains invalid JSON data."}, status_code=400
-        )
-
-    return data
+    # serve the crawler's pre-compressed copy if the client accepts it
+    qvalues = _parse_accept_encoding(request.headers.get("accept-encoding", ""))
+    offers = [
+        (qvalues.get(encoding, qvalues.get("*", 0)), encoding, suffix)
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz"))
+    ]
+    # highest q first, sorted() is stable so br wins ties
+    for q, encoding, suffix in sorted(offers, key=lambda offer: -offer[0]):
+        if q <= 0:
+            continue
+        try:
+            compressed_st = await asyncio.to_thread(os.stat, NODE_OUTPUT_FILE + suffix)
+        except FileNotFoundError:
+            continue
+        if compressed_st.st_mtime_ns >= st.st_mtime_ns:
+            return FileResponse(
+                NODE_OUTPUT_FILE + suffix,
+                media_type="application/json",
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+            )
+
+    return Response(
+        content=_cache["body"],
+        media_type="application/json",
+        headers={"Vary": "Accept-Encoding"},
+    )
 
 
 @app.on_event("startup")
@@ -66,29 +133,68 @@ async def init_data():
     logging.info("Scheduler started")
 
 
+def _run_crawl(addresses, network, output, api_key, start_address):
+    """Crawler entry point in the executor's child process."""
+    # imported here so the API process never loads grpc and the protobuf modules
+    from spectre_crawler import main
+
+    try:
+        asyncio.run(
+            asyncio.wait_for(
+                main(
+                    addresses,
+                    network,
+                    output,
+                    api_key=api_key,
+                    start_address=start_address,
+                ),
+                timeout=30 * 60,  # 30min
+            )
+        )
+    except asyncio.TimeoutError:
+        logging.warning("Crawler job exceeded the maximum runtime of 30 minutes.")
+
+
+def _stop_crawl(process, timeout=5):
+    """Terminate a crawl process, killing it if it doesn't exit in time."""
+    process.terminate()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
 async def update_nodes():
-    """Run the crawler asynchronously."""
+    """Run the crawler in a child process without blocking the event loop."""
     logging.info("Starting crawler job")
     hostpair = seed_node.split(":") if ":" in seed_node else (seed_node, "18111")
+    process = multiprocessing.get_context("spawn").Process(
+        target=_run_crawl,
+        args=([hostpair], "spectre-mainnet", NODE_OUTPUT_FILE, api_key, seed_node),
+        daemon=True,
+    )
+    _crawl["process"] = process
     try:
-        await asyncio.wait_for(
-            main(
-                [hostpair],
-                "spectre-mainnet",
-                NODE_OUTPUT_FILE,
-                api_key=api_key,
-                start_address=seed_node,
-            ),
-            timeout=30 * 60,  # 30min
-        )
-    except asyncio.TimeoutError:
-        logging.warning("Crawler job exceeded the maximum runtime of 15 minutes.")
+        process.start()
+        # the child enforces the 30 minute limit itself, this catches a hung child
+        await asyncio.to_thread(process.join, 31 * 60)
+        if process.is_alive():
+            logging.warning("Crawler job did not exit in time, terminating it.")
+            await asyncio.to_thread(_stop_crawl, process)
+        elif process.exitcode != 0:
+            logging.error("Crawler job failed with exit code %s", process.exitcode)
     except Exception as e:
-        logging.error(f"An error occurred during the crawler job: {e}")
+        logging.error("An error occurred during the crawler job: %s", e)
+    finally:
+        _crawl["process"] = None
 
 
 @app.on_event("shutdown")
 async def shutdown_scheduler():
-    """Shutdown the scheduler gracefully."""
+    """Shutdown the scheduler and stop a running crawler process."""
     logging.info("Shutting down scheduler.")
     scheduler.shutdown(wait=True)
+    process = _crawl["process"]
+    if process is not None and process.is_alive():
+        logging.info("Stopping the running crawler job.")
+        await asyncio.to_thread(_stop_crawl, process)
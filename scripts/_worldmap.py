@@ -0,0 +1,36 @@
+import os
+
+import geopandas as gpd
+
+WORLDMAP_PATH = "admin_0_countries/ne_110m_admin_0_countries.shp"
+WORLDMAP_CACHE = "admin_0_countries/ne_110m_admin_0_countries.feather"
+
+
+def load_worldmap(path=WORLDMAP_PATH, cache=WORLDMAP_CACHE):
+    """
+    Load the world map shapefile, parsing it is slow so a feather copy is
+    reused between runs. The copy is best-effort: feather needs the optional
+    pyarrow package and a writable directory, without them the shapefile is
+    read every time.
+    """
+    cache_is_fresh = os.path.exists(cache) and (
+        os.path.getmtime(cache) >= os.path.getmtime(path)
+    )
+    if cache_is_fresh:
+        try:
+            return gpd.read_feather(cache)
+        except (ImportError, OSError, ValueError):
+            pass
+
+    worldmap = gpd.read_file(path)
+    # write to a temp file and rename, an interrupted run never leaves a
+    # partial copy that looks fresh
+    try:
+        worldmap.to_feather(cache + ".tmp")
+        os.replace(cache + ".tmp", cache)
+    except (ImportError, OSError, ValueError):
+        try:
+            os.remove(cache + ".tmp")
+        except OSError:
+            pass
+    return worldmap
@@ -1,8 +1,11 @@
-import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
-import json
+from matplotlib.lines import Line2D
+import orjson
 import argparse
+import re
+
+from _worldmap import load_worldmap
 
 parser = argparse.ArgumentParser(description="Plots the crawling result on a map")
 parser.add_argument(
@@ -13,8 +16,8 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
-with open(args.input, "r") as f:
-    all_info = json.load(f)
+with open(args.input, "rb") as f:
+    all_info = orjson.loads(f.read())
 
 nodes = all_info.get("nodes", all_info)
 
@@ -32,8 +35,7 @@ location_df = pd.DataFrame(
     ]
 )
 
-worldmap_path = "admin_0_countries/ne_110m_admin_0_countries.shp"
-worldmap = gpd.read_file(worldmap_path)
+worldmap = load_worldmap()
 
 # Create and plot the world map
 fig, ax = plt.subplots(figsize=(12, 6))
@@ -42,16 +44,26 @@ worldmap.plot(color="lightgrey", ax=ax)
 # Define colors based on node versions
 color_map = {"0.3.14": "red", "0.3.15": "orange", "0.3.16": "green"}
 
-for version, color in color_map.items():
-    version_nodes = location_df[location_df["version"].str.contains(version)]
-    if not version_nodes.empty:
-        y = version_nodes["loc"].str.split(",").str[0].astype("float")  # Latitude
-        x = version_nodes["loc"].str.split(",").str[1].astype("float")  # Longitude
-        plt.scatter(x, y, s=5, color=color, label=f"Version {version}")
+# extract the version and parse "lat,lon" once, then plot in a single call
+version_pattern = "(" + "|".join(re.escape(version) for version in color_map) + ")"
+location_df["ver"] = location_df["version"].str.extract(version_pattern, expand=False)
+location_df["color"] = location_df["ver"].map(color_map)
+location_df = location_df.dropna(subset=["color"])
+location_df[["lat", "lon"]] = (
+    location_df["loc"].str.extract(r"([^,]+),(.+)").astype("float")
+)
+plt.scatter(location_df["lon"], location_df["lat"], s=5, c=location_df["color"])
+
+plotted_versions = set(location_df["ver"])
+legend_handles = [
+    Line2D([], [], marker="o", linestyle="", color=color, label=f"Version {version}")
+    for version, color in color_map.items()
+    if version in plotted_versions
+]
 
 # Set plot limits, legend, and save
 plt.xlim([-180, 180])
 plt.ylim([-90, 90])
-plt.legend(loc="upper right")
+plt.legend(handles=legend_handles, loc="upper right")
 plt.savefig(args.output)
 print(f"Map saved to {args.output}")
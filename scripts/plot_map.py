@@ -1,9 +1,10 @@
-import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
-import json
+import orjson
 import argparse
 
+from _worldmap import load_worldmap
+
 parser = argparse.ArgumentParser(description="Plots the crawling result on a map")
 parser.add_argument(
     "-i", "--input", help="The JSON file with crawling results", required=True
@@ -13,8 +14,8 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
-with open(args.input, "r") as f:
-    all_info = json.load(f)
+with open(args.input, "rb") as f:
+    all_info = orjson.loads(f.read())
 
 nodes = all_info.get("nodes", all_info)
 
@@ -29,16 +30,17 @@ location_df = pd.DataFrame(
     [{"address": k, "loc": v["loc"]} for k, v in valid_nodes.items()]
 )
 
-worldmap_path = "admin_0_countries/ne_110m_admin_0_countries.shp"
-worldmap = gpd.read_file(worldmap_path)
+worldmap = load_worldmap()
 
 # Create and plot the world map
 fig, ax = plt.subplots(figsize=(12, 6))
 worldmap.plot(color="lightgrey", ax=ax)
 
-y = location_df["loc"].str.split(",").str[0].astype("float")  # Latitude
-x = location_df["loc"].str.split(",").str[1].astype("float")  # Longitude
-plt.scatter(x, y, s=5, color="blue")
+# parse "lat,lon" once into both columns
+location_df[["lat", "lon"]] = (
+    location_df["loc"].str.extract(r"([^,]+),(.+)").astype("float")
+)
+plt.scatter(location_df["lon"], location_df["lat"], s=5, color="blue")
 
 plt.xlim([-180, 180])
 plt.ylim([-90, 90])
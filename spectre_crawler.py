@@ -2,19 +2,133 @@ import logging
 import os
 import grpc
 import time
-import random
+import secrets
+import functools
 import ipaddress
 import asyncio
-import json
+import orjson
 import aiohttp
+import brotli
+import gzip
 import platform
 import argparse
+import sqlite3
 
 import p2p_pb2
 import messages_pb2
 import messages_pb2_grpc
 
 
+def extract_ip_address(address):
+    """
+    Return the normalized ip of an "ip:port" or "ipv6:[ip]:port" address,
+    or None if it doesn't hold a valid ip.
+    """
+    if address.startswith("ipv6:["):
+        end = address.find("]")
+        candidate = address[6:end] if end > 0 else None
+    else:
+        candidate = address.rsplit(":", 1)[0]
+    try:
+        return str(ipaddress.ip_address(candidate)) if candidate else None
+    except ValueError:
+        return None
+
+
+def _networks(*cidrs):
+    return [
+        (int(net.network_address), int(net.netmask))
+        for net in map(ipaddress.ip_network, cidrs)
+    ]
+
+
+# ranges ipaddress reports as private or loopback, as (network, netmask) ints
+_PRIVATE_V4 = _networks(
+    "0.0.0.0/8",
+    "10.0.0.0/8",
+    "127.0.0.0/8",
+    "169.254.0.0/16",
+    "172.16.0.0/12",
+    "192.0.0.0/29",
+    "192.0.0.170/31",
+    "192.0.2.0/24",
+    "192.168.0.0/16",
+    "198.18.0.0/15",
+    "198.51.100.0/24",
+    "203.0.113.0/24",
+    "240.0.0.0/4",
+    "255.255.255.255/32",
+)
+_PRIVATE_V6 = _networks(
+    "::1/128",
+    "::/128",
+    "100::/64",
+    "2001::/23",
+    "2001:2::/48",
+    "2001:10::/28",
+    "2001:db8::/32",
+    "fc00::/7",
+    "fe80::/10",
+)
+
+
+def is_public_ip(ipstr):
+    """
+    Check a packed 4 or 16 byte ip against the private ranges with integer
+    masks, avoiding an ipaddress object per address.
+    """
+    if len(ipstr) == 4:
+        private = _PRIVATE_V4
+    elif len(ipstr) == 16:
+        private = _PRIVATE_V6
+    else:
+        raise ValueError(f"{ipstr!r} is not a packed IPv4 or IPv6 address")
+    value = int.from_bytes(ipstr, "big")
+    if private is _PRIVATE_V6 and value >> 32 == 0xFFFF:
+        # ipv4-mapped ipv6, check the embedded ipv4 address
+        private, value = _PRIVATE_V4, value & 0xFFFFFFFF
+    return not any(value & netmask == network for network, netmask in private)
+
+
+@functools.lru_cache(maxsize=65536)
+def _fmt_addr(ipstr, port):
+    """
+    Format a packed ip and port as a grpc target, None for private ips.
+    the same peers are announced by many nodes, so results are cached.
+    """
+    if not is_public_ip(ipstr):
+        return None
+    ip = ipaddress.ip_address(ipstr)
+    if isinstance(ip, ipaddress.IPv6Address):
+        return f"ipv6:[{ip}]:{port}"
+    return f"{ip}:{port}"
+
+
+def _classify(addresses, bad_ipstrs):
+    """
+    Split announced (ip, port) pairs into public grpc targets and the
+    malformed ips that should be skipped from now on.
+    """
+    neighbors = []
+    bad = []
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for ipstr, port in addresses:
+        if ipstr in bad_ipstrs:
+            continue
+        try:
+            new_address = _fmt_addr(ipstr, port)
+        except Exception:
+            logging.exception("Bad ip")
+            bad.append(ipstr)
+            continue
+        if new_address is None:
+            if debug:
+                logging.debug("Got private address %s", ipaddress.ip_address(ipstr))
+            continue
+        neighbors.append(new_address)
+    return neighbors, bad
+
+
 def filter_obfuscate(nodes):
     """
     Remove duplicate ids, obfuscate IP and filter nodes without loc data.
@@ -28,12 +142,12 @@ def filter_obfuscate(nodes):
 
         # skip missing loc
         if not loc:
-            logging.warning(f"skipped, missing location: {node_data}")
+            logging.warning("skipped, missing location: %s", node_data)
             continue
 
         # handle duplicate
         if node_id in seen_ids:
-            logging.info(f"Duplicate id found: {node_id}.")
+            logging.info("Duplicate id found: %s.", node_id)
             continue
 
         seen_ids[node_id] = True
@@ -54,20 +168,277 @@ def filter_obfuscate(nodes):
 
             unique_nodes[obfuscated_key] = node_data
         except (ValueError, IndexError) as e:
-            logging.error(f"Malformed address skipped: {ip_port} ({e})")
+            logging.error("Malformed address skipped: %s (%s)", ip_port, e)
             continue
 
     return unique_nodes
 
 
+GEO_API_URL = "https://api.ipgeolocation.io/ipgeo"
+GEO_BULK_API_URL = "https://api.ipgeolocation.io/ipgeo-bulk"
+GEO_BULK_SIZE = 50  # max ips per bulk request
+GEO_CONCURRENCY = 20  # max concurrent per-ip requests, avoids rate limiting
+GEO_CACHE_FILE = "geo.sqlite"  # stored next to the output file
+
+
+def _format_loc(resp):
+    if "latitude" in resp and "longitude" in resp:
+        return f"{resp['latitude']},{resp['longitude']}"
+    return ""
+
+
+async def ipinfo(session, addr, api_key):
+    """
+    Geolocate a single ip, returns "lat,lon", "" if the api has no location
+    for it, or None if the request failed and is worth retrying later.
+    """
+    logging.debug("Requesting geolocation for %s", addr)
+    api_url = f"{GEO_API_URL}?apiKey={api_key}&ip={addr}&fields=latitude,longitude"
+    try:
+        async with session.get(api_url) as response:
+            if response.status != 200:
+                logging.warning(
+                    "Geolocation request for %s failed with status %s",
+                    addr,
+                    response.status,
+                )
+                return None
+
+            resp = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.warning("Error reading geolocation data for %s: %s", addr, e)
+        return None
+
+    logging.debug("Geolocation response for %s: %s", addr, resp)
+    if not isinstance(resp, dict):
+        logging.warning("Unexpected geolocation response for %s: %s", addr, resp)
+        return None
+
+    # check if required data (latitude and longitude) is available
+    loc = _format_loc(resp)
+    if loc:
+        logging.info("Geolocation for %s found: %s", addr, loc)
+    else:
+        logging.warning(
+            "Geolocation response is missing location for %s: %s", addr, resp
+        )
+    return loc
+
+
+async def ipinfo_bulk(session, addrs, api_key):
+    """
+    Geolocate up to GEO_BULK_SIZE ips in one request.
+    Returns {ip: "lat,lon"}, or None if the bulk endpoint is unavailable
+    (it requires a paid plan).
+    """
+    api_url = f"{GEO_BULK_API_URL}?apiKey={api_key}&fields=latitude,longitude"
+    try:
+        async with session.post(api_url, json={"ips": addrs}) as response:
+            if response.status != 200:
+                logging.warning(
+                    "Bulk geolocation request failed with status %s", response.status
+                )
+                return None
+            resp = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.warning("Error reading bulk geolocation data: %s", e)
+        return None
+
+    logging.debug("Bulk geolocation response: %s", resp)
+    if not isinstance(resp, list):
+        logging.warning("Unexpected bulk geolocation response: %s", resp)
+        return None
+    return {r["ip"]: _format_loc(r) for r in resp if isinstance(r, dict) and "ip" in r}
+
+
+class GeoCache(object):
+    """
+    Persistent ip -> "lat,lon" cache so restarts don't repeat paid lookups.
+    ips the api answered without a location are cached as "" for a shorter
+    time, failed requests are never cached.
+    """
+
+    FRESH = "(loc != '' AND ts > ?) OR (loc = '' AND ts > ?)"
+
+    def __init__(self, path, max_age=30 * 86400, negative_max_age=86400):
+        self.max_age = max_age
+        self.negative_max_age = negative_max_age
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geo (ip TEXT PRIMARY KEY, loc TEXT, ts INTEGER)"
+        )
+        # drop expired entries so the table doesn't grow with every ip ever seen
+        with self.conn:
+            self.conn.execute(
+                f"DELETE FROM geo WHERE NOT ({self.FRESH})", self._cutoffs()
+            )
+
+    def _cutoffs(self):
+        now = int(time.time())
+        return now - self.max_age, now - self.negative_max_age
+
+    def get_many(self, ips, chunk_size=500):
+        # look ips up by primary key, in chunks below sqlite's variable limit
+        ips = list(dict.fromkeys(ips))
+        cutoffs = self._cutoffs()
+        locs = {}
+        for i in range(0, len(ips), chunk_size):
+            chunk = ips[i : i + chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT ip, loc FROM geo WHERE ip IN ({placeholders})"
+                f" AND ({self.FRESH})",
+                (*chunk, *cutoffs),
+            )
+            locs.update(rows)
+        return locs
+
+    def set_many(self, locs):
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO geo (ip, loc, ts) VALUES (?, ?, ?)",
+                ((ip, loc, now) for ip, loc in locs.items()),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+async def _bounded(limiter, coro):
+    async with limiter:
+        return await coro
+
+
+async def geolocate(nodes, api_key=None, start_address=None, cache=None):
+    """
+    Fill in the "loc" field of every node, batching lookups through the
+    bulk endpoint and falling back to per-ip requests.
+    ips found in the optional GeoCache are not looked up again.
+    """
+    addrs = {}
+    for address in nodes:
+        addr = extract_ip_address(address)
+
+        # skip starting address specified with --addr
+        if start_address and address.startswith(start_address.split(":")[0] + ":"):
+            logging.info("Skipping geolocation for start address %s", address)
+            nodes[address]["loc"] = ""
+            continue
+        if addr is None:
+            logging.warning("Skipping geolocation for malformed address %s", address)
+            nodes[address]["loc"] = ""
+            continue
+        addrs[address] = addr
+
+    locs = cache.get_many(addrs.values()) if cache else {}
+    logging.info("Geolocation cache hits: %d/%d", len(locs), len(addrs))
+
+    fetched = {}
+    connector = aiohttp.TCPConnector(limit=50, limit_per_host=20, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=10)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            # nodes sharing an ip on different ports need a single lookup
+            ips = list(dict.fromkeys(ip for ip in addrs.values() if ip not in locs))
+            chunks = [
+                ips[i : i + GEO_BULK_SIZE] for i in range(0, len(ips), GEO_BULK_SIZE)
+            ]
+            semaphore = asyncio.Semaphore(GEO_CONCURRENCY)
+
+            # probe the bulk endpoint with the first chunk, then send the rest at once
+            found = await ipinfo_bulk(session, chunks[0], api_key) if chunks else None
+            if found is not None:
+                fetched.update(found)
+                results = await asyncio.gather(
+                    *(
+                        _bounded(semaphore, ipinfo_bulk(session, chunk, api_key))
+                        for chunk in chunks[1:]
+                    ),
+                    return_exceptions=True,
+                )
+                for found in results:
+                    if isinstance(found, Exception):
+                        logging.warning("Bulk geolocation failed: %r", found)
+                    elif found:
+                        fetched.update(found)
+
+            missing = [ip for ip in ips if ip not in fetched]
+            results = await asyncio.gather(
+                *(_bounded(semaphore, ipinfo(session, ip, api_key)) for ip in missing),
+                return_exceptions=True,
+            )
+            for ip, loc in zip(missing, results):
+                # failed requests are not cached, the next run asks again
+                if isinstance(loc, Exception):
+                    logging.warning("Geolocation for %s failed: %r", ip, loc)
+                elif loc is not None:
+                    fetched[ip] = loc
+    finally:
+        # keep whatever was looked up, even if the rest of the lookups failed
+        if cache:
+            cache.set_many(fetched)
+        locs.update(fetched)
+
+        for address, addr in addrs.items():
+            nodes[address]["loc"] = locs.get(addr, "")
+
+
+def _write_atomic(path, data):
+    # write to a temp file and rename, readers never see a partial file
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def write_output(output, data):
+    """
+    Write the results plus pre-compressed .gz and .br copies served by the API.
+    The copies are written last so they are never older than the json file.
+    """
+    _write_atomic(output, data)
+    _write_atomic(output + ".gz", gzip.compress(data))
+    _write_atomic(output + ".br", brotli.compress(data, quality=5))
+
+
 async def message_stream(queue):
-    message = await queue.get()
-    while message is not None:
+    # runs until the stream is cancelled in P2PNode.__aexit__
+    while True:
+        message = await queue.get()
         logging.debug("Sending %s", message)
         yield message
-        queue.task_done()
-        message = await queue.get()
-    queue.task_done()
+
+
+# larger windows so big address replies arrive in fewer round trips,
+# keepalives so dead peers are dropped before the tcp timeout
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.http2.lookahead_bytes", 1 << 20),
+    ("grpc.http2.max_frame_size", 1 << 20),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+    ("grpc.http2.bdp_probe", 1),
+    ("grpc.max_receive_message_length", 16 << 20),
+    ("grpc.keepalive_time_ms", 20000),
+]
+
+
+# stateless messages, shared by every peer and never mutated
+_VERACK_MSG = messages_pb2.SpectredMessage(verack=p2p_pb2.VerackMessage())
+_READY_MSG = messages_pb2.SpectredMessage(ready=p2p_pb2.ReadyMessage())
+_REQ_ADDR_MSG = messages_pb2.SpectredMessage(
+    requestAddresses=p2p_pb2.RequestAddressesMessage()
+)
+_NO_ADDR_MSG = messages_pb2.SpectredMessage(
+    addresses=p2p_pb2.AddressesMessage(addressList=[])
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _version_template(user_agent, network):
+    # the per-peer fields are filled in on a copy during the handshake
+    return p2p_pb2.VersionMessage(userAgent=user_agent, network=network)
 
 
 class P2PNode(object):
@@ -77,73 +448,15 @@ class P2PNode(object):
         self,
         address="localhost:18111",
         network="spectre-mainnet",
-        api_key=None,
-        start_address=None,
     ):
         self.network = network
         self.address = address
-        self.api_key = api_key
-        self.start_address = start_address
-
-    async def ipinfo(self, session):
-        addr, _ = self.address.rsplit(":", 1)
-        addr = addr.replace("ipv6:", "").strip("[]")
-
-        # skip starting address specified with --addr
-        if self.start_address and addr == self.start_address.split(":")[0]:
-            logging.info(f"Skipping geolocation for start address {addr}")
-            return ""
-
-        retries = 2
-        while retries > 0:
-            try:
-                logging.debug(
-                    f"Requesting geolocation for {addr} (retries left: {retries})"
-                )
-                api_url = f"https://api.ipgeolocation.io/ipgeo?apiKey={self.api_key}&ip={addr}&fields=latitude,longitude"
-
-                timeout = aiohttp.ClientTimeout(total=15)  # 15 seconds timeout
-                async with session.get(api_url, timeout=timeout) as response:
-                    if response.status != 200:
-                        logging.warning(
-                            f"Geolocation request for {addr} failed with status {response.status}"
-                        )
-                        retries -= 1
-                        await asyncio.sleep(2)  # wait
-                        continue
-
-                    resp = await response.json()
-                    logging.debug(f"Geolocation response for {addr}: {resp}")
-
-                    # check if required data (latitude and longitude) is available
-                    if "latitude" in resp and "longitude" in resp:
-                        latitude = resp["latitude"]
-                        longitude = resp["longitude"]
-                        loc = f"{latitude},{longitude}"
-                        logging.info(f"Geolocation for {addr} found: {loc}")
-                        return loc
-                    else:
-                        logging.warning(
-                            f"Geolocation response is missing location for {addr}: {resp}"
-                        )
-                        return ""
-
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logging.warning(
-                    f"Error reading geolocation data for {addr} (retries left: {retries}): {e}"
-                )
-                retries -= 1
-                await asyncio.sleep(2)
-
-        # skip this IP and return an empty location
-        logging.warning(
-            f"Failed to retrieve geolocation for {addr} after multiple attempts, skipping."
-        )
-        return ""
 
     async def __aenter__(self):
-        self.ID = bytes.fromhex(hex(int(random.random() * 10000))[2:].zfill(32))
-        self.channel = grpc.aio.insecure_channel(self.address)
+        self.ID = secrets.token_bytes(16)
+        self.channel = grpc.aio.insecure_channel(
+            self.address, options=GRPC_CHANNEL_OPTIONS
+        )
 
         self.peer_version = 2
         self.peer_id = None
@@ -159,12 +472,9 @@ class P2PNode(object):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.send_queue.put(None)
-        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
-            self.stream.cancel()
-        else:
-            await self.send_queue.join()
-        await self.channel.close(2)
+        # nothing left worth sending, unsent frames are dropped with the channel
+        self.stream.cancel()
+        await self.channel.close(grace=0)
 
     async def handshake(self):
         logging.debug("Starting handshake")
@@ -175,88 +485,103 @@ class P2PNode(object):
                 self.peer_id = item.version.id
                 self.peer_version = item.version.protocolVersion
                 self.peer_spectred = item.version.userAgent
-                await self.send_queue.put(
-                    messages_pb2.SpectredMessage(
-                        version=p2p_pb2.VersionMessage(
-                            protocolVersion=self.peer_version,
-                            timestamp=int(time.time()),
-                            id=self.ID,
-                            userAgent=self.USER_AGENT,
-                            network=self.network,
-                        )
-                    )
-                )
+                version = p2p_pb2.VersionMessage()
+                version.CopyFrom(_version_template(self.USER_AGENT, self.network))
+                version.protocolVersion = self.peer_version
+                version.timestamp = int(time.time())
+                version.id = self.ID
+                await self.send_queue.put(messages_pb2.SpectredMessage(version=version))
             elif payload == "verack":
-                await self.send_queue.put(
-                    messages_pb2.SpectredMessage(verack=p2p_pb2.VerackMessage())
-                )
+                await self.send_queue.put(_VERACK_MSG)
                 if self.peer_version < 4:
                     logging.debug("Handshake done")
                     return
             elif payload == "ready":
-                await self.send_queue.put(
-                    messages_pb2.SpectredMessage(ready=p2p_pb2.ReadyMessage())
-                )
+                await self.send_queue.put(_READY_MSG)
                 logging.debug("Handshake done")
                 return
             else:
                 logging.debug("During handshake, got unexpected %s", payload)
 
-    async def get_addresses(self):
-        logging.debug("Starting get_addresses")
-        await self.send_queue.put(
-            messages_pb2.SpectredMessage(
-                requestAddresses=p2p_pb2.RequestAddressesMessage()
-            )
-        )
+    async def request_addresses(self, n=1):
+        logging.debug("Requesting addresses %d times", n)
+        for _ in range(n):
+            await self.send_queue.put(_REQ_ADDR_MSG)
+
+    async def drain_addresses(self, addresses, n=1):
+        """
+        Read the replies to n pipelined address requests, merging each one
+        into the (ip, port) -> timestamp dict as it arrives so replies read
+        before a timeout are kept.
+        """
+        replies = 0
         async for item in self.stream:
             logging.debug("Getting %s", item)
             payload = item.WhichOneof("payload")
             if payload == "addresses":
-                return item.addresses.addressList
+                for x in item.addresses.addressList:
+                    key = (x.ip, x.port)
+                    if addresses.get(key, 0) < x.timestamp:
+                        addresses[key] = x.timestamp
+                replies += 1
+                if replies >= n:
+                    break
             elif payload == "requestAddresses":
-                await self.send_queue.put(
-                    messages_pb2.SpectredMessage(
-                        addresses=p2p_pb2.AddressesMessage(addressList=[])
-                    )
-                )
+                await self.send_queue.put(_NO_ADDR_MSG)
+
+
+# replies with at least this many addresses are classified off the loop
+CLASSIFY_IN_THREAD = 1000
+
+# per-peer budget for address discovery
+PEER_DEADLINE = 8.0
+PEER_MAX_ADDRS = 5000
 
 
-async def get_addresses(
-    address, network, semaphore: asyncio.Semaphore, api_key=None, start_address=None
-):
+async def get_addresses(address, network):
     try:
-        addresses = set()
-        prev_size = -1
-        patience = 10
+        # (ip, port) -> latest timestamp, so re-announced peers aren't counted twice
+        addresses = {}
+        stale = 0
         peer_id = ""
         peer_spectred = ""
         protocol_version = None
-        loc = ""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with P2PNode(
-                    address, network, api_key=api_key, start_address=start_address
-                ) as node:
-                    peer_id = node.peer_id.hex()
-                    peer_spectred = node.peer_spectred
-                    protocol_version = node.peer_version
-                    prev = time.time()
-                    while len(addresses) > prev_size or patience > 0:
-                        if time.time() - prev > 5:
-                            logging.info("getting more addresses")
-                            prev = time.time()
-                        if len(addresses) <= prev_size:
-                            patience -= 1
-                        else:
-                            patience = 10
-                        prev_size = len(addresses)
-                        item = await node.get_addresses()
-                        if item is not None:
-                            addresses.update(
-                                ((x.timestamp, x.ip, x.port) for x in item)
-                            )
-                    loc = await node.ipinfo(session)
+            async with P2PNode(address, network) as node:
+                peer_id = node.peer_id.hex()
+                peer_spectred = node.peer_spectred
+                protocol_version = node.peer_version
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                deadline = start + PEER_DEADLINE
+                # requests kept in flight per round trip
+                batch = 4
+                while stale < 3 and len(addresses) < PEER_MAX_ADDRS:
+                    now = loop.time()
+                    if now >= deadline:
+                        break
+                    prev_size = len(addresses)
+                    await node.request_addresses(batch)
+                    try:
+                        await asyncio.wait_for(
+                            node.drain_addresses(addresses, batch), deadline - now
+                        )
+                    except asyncio.TimeoutError:
+                        # whatever arrived before the deadline is already merged
+                        break
+                    # grow the pipeline while replies keep bringing new peers
+                    if len(addresses) > prev_size:
+                        stale = 0
+                        batch = min(batch * 2, 16)
+                    else:
+                        stale += 1
+                        batch = max(batch // 2, 1)
+                logging.debug(
+                    "Got %d addresses from %s in %.1fs",
+                    len(addresses),
+                    address,
+                    loop.time() - start,
+                )
 
         except asyncio.exceptions.TimeoutError:
             logging.debug("Node %s timed out", address)
@@ -267,15 +592,15 @@ async def get_addresses(
                 protocol_version,
                 addresses,
                 "timeout",
-                loc,
             )
         except Exception as e:
             logging.exception("Error in task")
-            return address, peer_id, peer_spectred, protocol_version, addresses, e, loc
+            return address, peer_id, peer_spectred, protocol_version, addresses, e
 
-        return address, peer_id, peer_spectred, protocol_version, addresses, "", loc
+        return address, peer_id, peer_spectred, protocol_version, addresses, ""
     except asyncio.CancelledError:
         logging.debug("Task was canceled")
+        raise
 
 
 async def main(addresses, network, output, api_key=None, start_address=None):
@@ -288,96 +613,84 @@ async def main(addresses, network, output, api_key=None, start_address=None):
         ulimit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
         ulimit = max(ulimit - 20, 1)
 
-    logging.info(f"Running {ulimit} tasks concurrently")
-    semaphore = asyncio.Semaphore(ulimit)
+    logging.info("Running %d tasks concurrently", ulimit)
 
     res = {}
-    bad_ipstrs = []
+    bad_ipstrs = set()
     seen = set()
-    pending = [
-        asyncio.create_task(
-            get_addresses(
-                f"{address}:{port}",
-                network,
-                semaphore,
-                api_key=api_key,
-                start_address=start_address,
+    work = asyncio.Queue()
+    workers = []
+    idle = 0
+
+    def enqueue(address):
+        # workers are started lazily, only when nobody is free to take the address
+        work.put_nowait(address)
+        if work.qsize() > idle and len(workers) < ulimit:
+            workers.append(asyncio.create_task(worker()))
+
+    async def worker():
+        nonlocal idle
+        while True:
+            idle += 1
+            try:
+                address = await work.get()
+            finally:
+                idle -= 1
+            try:
+                await crawl(address)
+            except asyncio.TimeoutError:
+                logging.warning("Task timed out and was cancelled")
+            except Exception:
+                logging.exception("Crawling %s failed", address)
+            finally:
+                work.task_done()
+
+    async def crawl(address):
+        # at most ulimit workers, so at most ulimit open channels
+        result = await asyncio.wait_for(get_addresses(address, network), timeout=120)
+        (
+            address,
+            peer_id,
+            peer_spectred,
+            protocol_version,
+            addresses,
+            error,
+        ) = result
+
+        res[address] = {
+            "neighbors": [],
+            "id": peer_id,
+            "spectred": peer_spectred,
+            "protocolVersion": protocol_version,
+            "error": error,
+        }
+        if error is not None:
+            res[address]["error"] = repr(error)
+        if len(addresses) >= CLASSIFY_IN_THREAD:
+            # keep the loop serving other peers while a big reply is parsed
+            neighbors, bad = await asyncio.to_thread(
+                _classify, list(addresses), frozenset(bad_ipstrs)
             )
-        )
-        for address, port in addresses
-    ]
-    start_time = time.time()
-    timeout_time = start_time + 60 * 25  # 25 minutes
+        else:
+            neighbors, bad = _classify(addresses, bad_ipstrs)
+        bad_ipstrs.update(bad)
+        res[address]["neighbors"] = neighbors
+        for new_address in neighbors:
+            if new_address not in seen:
+                seen.add(new_address)
+                enqueue(new_address)
 
-    try:
-        while len(pending) > 0 and time.time() < timeout_time:
-            logging.info(f"Currently pending: {len(pending)}")
-            done, pending = await asyncio.wait(
-                pending, return_when=asyncio.FIRST_COMPLETED
-            )
+    for address, port in addresses:
+        enqueue(f"{address}:{port}")
 
-            for task in done:
-                try:
-                    result = task.result()
-                    if result is None:
-                        continue
-                    (
-                        address,
-                        peer_id,
-                        peer_spectred,
-                        protocol_version,
-                        addresses,
-                        error,
-                        loc,
-                    ) = result
-                except asyncio.TimeoutError:
-                    logging.warning("Task timed out and was cancelled")
-                    continue
-
-                res[address] = {
-                    "neighbors": [],
-                    "id": peer_id,
-                    "spectred": peer_spectred,
-                    "protocolVersion": protocol_version,
-                    "error": error,
-                    "loc": loc,
-                }
-                if error is not None:
-                    res[address]["error"] = repr(error)
-                for ts, ipstr, port in addresses:
-                    if ipstr.hex() not in bad_ipstrs:
-                        try:
-                            ip = ipaddress.ip_address(ipstr)
-                            if not ip.is_private and not ip.is_loopback:
-                                if isinstance(ip, ipaddress.IPv6Address):
-                                    new_address = f"ipv6:[{ip}]:{port}"
-                                else:
-                                    new_address = f"{ip}:{port}"
-                                res[address]["neighbors"].append(new_address)
-                                if new_address not in seen:
-                                    seen.add(new_address)
-                                    pending.add(
-                                        asyncio.create_task(
-                                            asyncio.wait_for(
-                                                get_addresses(
-                                                    new_address,
-                                                    network,
-                                                    semaphore,
-                                                    api_key=api_key,
-                                                    start_address=start_address,
-                                                ),
-                                                timeout=120,
-                                            )
-                                        )
-                                    )
-                            else:
-                                logging.debug(f"Got private address {ip}")
-                        except Exception:
-                            logging.exception("Bad ip")
-                            bad_ipstrs.append(ipstr.hex())
-        logging.info("Done")
+    try:
+        try:
+            await asyncio.wait_for(work.join(), timeout=60 * 25)  # 25 minutes
+            logging.info("Done")
+        except asyncio.TimeoutError:
+            logging.warning("Crawl deadline reached with %d queued", work.qsize())
     finally:
-        for task in pending:
+        for task in workers:
             task.cancel()
 
         logging.info("Writing results...")
@@ -387,26 +700,29 @@ async def main(addresses, network, output, api_key=None, start_address=None):
                 clean_res[i] = res[i]
                 del clean_res[i]["neighbors"]
 
+        cache = GeoCache(os.path.join(os.path.dirname(output), GEO_CACHE_FILE))
+        try:
+            await geolocate(
+                clean_res, api_key=api_key, start_address=start_address, cache=cache
+            )
+        except Exception:
+            # nodes keep the locations found so far, the crawl is still written
+            logging.exception("Geolocation failed")
+        finally:
+            cache.close()
         unique_nodes = filter_obfuscate(clean_res)
 
-        async with semaphore:
-            if len(unique_nodes) >= 10:
-                json.dump(
-                    {"nodes": unique_nodes, "updated_at": int(time.time())},
-                    open(output, "w"),
-                    allow_nan=False,
-                    indent=2,
-                    sort_keys=True,
-                    ensure_ascii=True,
-                )
-
-        while len(pending) > 0:
-            logging.warning(
-                f"Shutting down after cancelling {len(pending)} tasks. Please wait..."
-            )
-            done, pending = await asyncio.wait(
-                pending, return_when=asyncio.FIRST_COMPLETED
+        if len(unique_nodes) >= 10:
+            data = orjson.dumps(
+                {"nodes": unique_nodes, "updated_at": int(time.time())},
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
             )
+            await asyncio.to_thread(write_output, output, data)
+
+        logging.warning(
+            "Shutting down after cancelling %d workers. Please wait...", len(workers)
+        )
+        await asyncio.gather(*workers, return_exceptions=True)
         logging.warning("All tasks seem to be down. Finalizing shut down...")
 
 